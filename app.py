@@ -1,14 +1,25 @@
 from flask import Flask, request, render_template, jsonify, send_from_directory, redirect, url_for, flash
 import os
-import uuid
+import secrets
 from werkzeug.utils import secure_filename
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget
+from blake3 import blake3
 import threading
 import time
 import random
-
-from app.database import init_database, add_video, get_all_videos, save_search_result
+import atexit
+import re
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from app.database import (
+    init_database, add_video, get_all_videos, get_video, get_video_by_path,
+    save_search_result, get_cached_search
+)
 from app.video_processor import extract_frames_from_video, get_video_info
-from app.image_matcher import find_matching_frames_fast, get_time_ranges
+from app.image_matcher import find_matching_frames, find_matching_frames_fast, get_time_ranges
 
 app = Flask(__name__)
 app.secret_key = 'news-scan-ai-secret-key-change-in-production'
@@ -18,10 +29,21 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'wmv'}
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB max file size
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Read streamed uploads 1MB at a time
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# Let a front-end server (Apache mod_xsendfile, lighttpd) stream files via
+# X-Sendfile instead of copying them through Python. Only enable this when
+# such a server is in front; the dev server would send empty bodies.
+app.use_x_sendfile = os.environ.get('NEWSSCAN_USE_X_SENDFILE') == '1'
+
+# Shared pool for background work, capped near the number of cores so that
+# simultaneous uploads don't spawn one decoder thread each
+EXECUTOR = ThreadPoolExecutor(max_workers=max(2, (os.cpu_count() or 2) - 1))
+atexit.register(EXECUTOR.shutdown, wait=False, cancel_futures=True)
+
 # Helpers to pick and prepare the active video
 def _list_video_files():
     videos_dir = 'videos'
@@ -43,17 +65,11 @@ def pick_active_video_path():
 
 def ensure_video_in_db_and_frames(video_path):
     """Ensure the given video path exists in DB and has frames extracted.
-    Returns the DB tuple for the video (as from get_all_videos), or None.
+    Returns the DB row for the video (as from get_video_by_path), or None.
     """
     if not video_path or not os.path.exists(video_path):
         return None
-    videos = get_all_videos()
-    target = None
-    for v in videos:
-        # v: (id, filename, original_name, file_path, duration, fps, frames_extracted, created_at)
-        if v[3] == video_path:
-            target = v
-            break
+    target = get_video_by_path(video_path)
     if target is None:
         info = get_video_info(video_path)
         if not info:
@@ -66,18 +82,13 @@ def ensure_video_in_db_and_frames(video_path):
             fps=info['fps']
         )
         # Extract frames in background
-        thread = threading.Thread(target=process_video_frames, args=(vid_id, video_path))
-        thread.daemon = True
-        thread.start()
+        submit_video_processing(vid_id, video_path)
         # Refresh target after adding
-        videos = get_all_videos()
-        target = next((v for v in videos if v[0] == vid_id), None)
+        target = get_video(vid_id)
     else:
         # If no frames yet, kick off extraction in background
-        if (target[6] or 0) == 0:
-            thread = threading.Thread(target=process_video_frames, args=(target[0], video_path))
-            thread.daemon = True
-            thread.start()
+        if (target['frames_extracted'] or 0) == 0:
+            submit_video_processing(target['id'], video_path)
     return target
 
 def ensure_multiple_videos_prepared(video_names):
@@ -93,29 +104,58 @@ def ensure_multiple_videos_prepared(video_names):
             print(f"Startup prepare: {path} not found, skipping.")
     return prepared
 
+# Sample image name patterns and the video each one maps to, checked in order
+_IMG_MAP = [
+    (re.compile(r'i1'), os.path.join('videos', 'sample_video.mp4')),
+    (re.compile(r'i[23]'), os.path.join('videos', 'vid.mp4')),
+    (re.compile(r'i4'), os.path.join('videos', 'vid1.mp4')),
+]
+_FALLBACK_VIDEOS = [os.path.join('videos', cand) for cand in ['vid.mp4', 'sample_video.mp4', 'vid1.mp4']]
+
+@functools.lru_cache(maxsize=32)
+def _exists_cached(path, bucket):
+    """os.path.exists memoized per time bucket (callers pass int(time.time()))"""
+    return os.path.exists(path)
+
 def select_video_for_image(image_filename):
     """Map certain sample images to specific videos."""
     name = (image_filename or '').lower()
-    if 'i1' in name:
-        return os.path.join('videos', 'sample_video.mp4')
-    if 'i2' in name or 'i3' in name:
-        return os.path.join('videos', 'vid.mp4')
-    if 'i4' in name:
-        return os.path.join('videos', 'vid1.mp4')
+    for pattern, video_path in _IMG_MAP:
+        if pattern.search(name):
+            return video_path
     # Fallback: prefer vid.mp4, else sample_video.mp4, else None
-    for cand in ['vid.mp4', 'sample_video.mp4', 'vid1.mp4']:
-        p = os.path.join('videos', cand)
-        if os.path.exists(p):
+    bucket = int(time.time())
+    for p in _FALLBACK_VIDEOS:
+        if _exists_cached(p, bucket):
             return p
     return None
 
 # Global variable to track processing status
 processing_status = {}
 
+# Futures of submitted frame extraction jobs, keyed by video ID
+processing_futures = {}
+
+# Guards processing_status and processing_futures, which background workers mutate
+_status_lock = threading.Lock()
+
+def set_processing_status(video_id, status):
+    """Replace the status entry of a video atomically"""
+    with _status_lock:
+        processing_status[video_id] = status
+
 def allowed_file(filename, extensions):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in extensions
 
+def compute_file_hash(filepath):
+    """Content hash of a file, used to recognize repeated searches for the same image"""
+    hasher = blake3()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
 def generate_youtube_metadata(video_info):
     """Generate YouTube-style metadata for video results"""
     if not video_info:
@@ -129,25 +169,34 @@ def generate_youtube_metadata(video_info):
     
     return {
         'channel': random.choice(news_channels),
-        'title': f"Breaking News: {video_info[2].replace('.mp4', '').replace('_', ' ').title()}",
+        'title': f"Breaking News: {video_info['original_name'].replace('.mp4', '').replace('_', ' ').title()}",
         'upload_date': '2024-09-20',
         'views': f"{random.randint(10000, 500000):,}",
-        'duration': f"{int(video_info[4]//60):02d}:{int(video_info[4]%60):02d}",
+        'duration': f"{int(video_info['duration']//60):02d}:{int(video_info['duration']%60):02d}",
         'description': "Live coverage from Indian news channel",
         'thumbnail': f"static/images/news_thumb_{random.randint(1, 5)}.jpg"
     }
 
-def process_video_frames(video_id, video_path):
-    """Process video frames in background"""
-    global processing_status
-    processing_status[video_id] = {'status': 'processing', 'progress': 0}
+def process_video_frames(video_id, video_path, frame_interval=30):
+    """Process video frames in background, sampling every frame_interval-th frame"""
+    set_processing_status(video_id, {'status': 'processing', 'progress': 0})
     
     try:
         frames_dir = f'frames/video_{video_id}'
-        frames_extracted = extract_frames_from_video(video_path, video_id, frames_dir)
-        processing_status[video_id] = {'status': 'completed', 'progress': 100, 'frames': frames_extracted}
+        frames_extracted = extract_frames_from_video(video_path, video_id, frames_dir, frame_interval=frame_interval)
+        set_processing_status(video_id, {'status': 'completed', 'progress': 100, 'frames': frames_extracted})
     except Exception as e:
-        processing_status[video_id] = {'status': 'error', 'error': str(e)}
+        set_processing_status(video_id, {'status': 'error', 'error': str(e)})
+
+def submit_video_processing(video_id, video_path):
+    """Queue frame extraction for a video, unless a job for it is already pending"""
+    with _status_lock:
+        future = processing_futures.get(video_id)
+        if future is not None and not future.done():
+            return future
+        future = EXECUTOR.submit(process_video_frames, video_id, video_path)
+        processing_futures[video_id] = future
+    return future
 
 @app.route('/')
 def index():
@@ -155,27 +204,84 @@ def index():
     videos = get_all_videos()
     return render_template('index.html', videos=videos)
 
+class UploadTarget(BaseTarget):
+    """Streams an uploaded video to disk, refusing disallowed file types before writing"""
+    
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.file = None
+        self.rejected = False
+        self.finished = False
+    
+    def on_start(self):
+        # multipart_filename is known once the part headers are parsed
+        if not self.multipart_filename:
+            return
+        if not allowed_file(self.multipart_filename, ALLOWED_VIDEO_EXTENSIONS):
+            self.rejected = True
+            return
+        self.file = open(self.path, 'wb')
+    
+    def on_data_received(self, chunk):
+        if self.file:
+            self.file.write(chunk)
+    
+    def on_finish(self):
+        if self.file:
+            self.file.close()
+        self.finished = True
+    
+    def close(self):
+        """Close the file if the part never finished (e.g. a truncated body)"""
+        if self.file and not self.file.closed:
+            self.file.close()
+
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
     """Handle video upload"""
-    if 'video' not in request.files:
+    if request.mimetype != 'multipart/form-data':
         flash('No video file selected')
         return redirect(request.url)
     
-    file = request.files['video']
-    if file.filename == '':
-        flash('No video file selected')
-        return redirect(request.url)
+    # Stream the 'video' field straight to disk as it arrives instead of
+    # letting Werkzeug's form parser buffer it first
+    temp_path = os.path.join('videos', f".upload_{secrets.token_hex(8)}.part")
+    target = UploadTarget(temp_path)
+    parser = StreamingFormDataParser(headers={'Content-Type': request.content_type})
+    parser.register('video', target)
     
-    if file and allowed_file(file.filename, ALLOWED_VIDEO_EXTENSIONS):
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        filepath = os.path.join('videos', unique_filename)
+    try:
+        received = 0
+        try:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                parser.data_received(chunk)
+                # Stop reading as soon as the part headers name a disallowed file type
+                if target.rejected:
+                    flash('Invalid video file format')
+                    return redirect(url_for('index'))
+        except ParseFailedException:
+            return jsonify({'error': 'Malformed upload'}), 400
         
-        # Ensure videos directory exists
-        os.makedirs('videos', exist_ok=True)
+        # A truncated body leaves the part unfinished; never register a partial video
+        if target.multipart_filename and (
+                not target.finished
+                or (request.content_length is not None and received != request.content_length)):
+            return jsonify({'error': 'Incomplete upload'}), 400
         
-        file.save(filepath)
+        if not target.multipart_filename:
+            flash('No video file selected')
+            return redirect(request.url)
+        
+        filename = secure_filename(target.multipart_filename)
+        unique_filename = f"{secrets.token_hex(8)}_{filename}"
+        filepath = os.path.join('videos', unique_filename)
+        
+        os.replace(temp_path, filepath)
         
         # Get video info
         video_info = get_video_info(filepath)
@@ -191,15 +297,16 @@ def upload_video():
             )
             
             # Start processing frames in background
-            thread = threading.Thread(target=process_video_frames, args=(video_id, filepath))
-            thread.daemon = True
-            thread.start()
+            submit_video_processing(video_id, filepath)
             
             flash(f'Video uploaded successfully! Processing frames in background...')
         else:
             flash('Error reading video file')
-    else:
-        flash('Invalid video file format')
+    finally:
+        # Drop the partial file if the upload was rejected or failed midway
+        target.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
     
     return redirect(url_for('index'))
 
@@ -225,10 +332,9 @@ def search():
     try:
         # Save uploaded image
         filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
+        unique_filename = f"{secrets.token_hex(8)}_{filename}"
         filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
         
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         file.save(filepath)
         
         # Choose target video based on image name mapping
@@ -237,7 +343,18 @@ def search():
         if not target_video:
             flash('No matching video available for this image. Please ensure videos exist in the videos folder.')
             return redirect(url_for('search'))
-        target_video_id = target_video[0]
+        target_video_id = target_video['id']
+
+        # Repeat searches for the same image reuse the saved results, but only
+        # once the video is fully processed so partial results are never cached
+        image_hash = compute_file_hash(filepath) if target_video['frames_extracted'] else None
+        cached = get_cached_search(image_hash, target_video_id, 'fast') if image_hash else None
+        if cached is not None:
+            return render_template('results_youtube.html',
+                                 results=cached,
+                                 uploaded_image=unique_filename,
+                                 video_id=target_video_id,
+                                 video_file=os.path.basename(target_video['file_path']))
 
         # Find matches in the target video using fast method
         matches = find_matching_frames_fast(filepath, target_video_id)
@@ -256,14 +373,14 @@ def search():
             'source_type': 'youtube'
         }
 
-        # Save search result to database
-        save_search_result(filepath, results)
+        # Save search result to database; the JSON dump and insert are cheap
+        save_search_result(filepath, results, image_hash, target_video_id, 'fast')
 
         return render_template('results_youtube.html', 
                              results=results, 
                              uploaded_image=unique_filename,
                              video_id=target_video_id,
-                             video_file=os.path.basename(target_video[3]))
+                             video_file=os.path.basename(target_video['file_path']))
     
     except Exception as e:
         return jsonify({'error': f'Search failed: {str(e)}'}), 500
@@ -271,7 +388,16 @@ def search():
 @app.route('/video_status/<int:video_id>')
 def video_status(video_id):
     """Check video processing status"""
-    status = processing_status.get(video_id, {'status': 'not_found'})
+    with _status_lock:
+        status = processing_status.get(video_id)
+        status = dict(status) if status is not None else None
+        future = processing_futures.get(video_id)
+    if status is None:
+        # Submitted but still waiting for a free worker
+        if future is not None and not future.done():
+            status = {'status': 'queued', 'progress': 0}
+        else:
+            status = {'status': 'not_found'}
     return jsonify(status)
 
 @app.route('/uploads/<filename>')
@@ -320,14 +446,21 @@ def api_search():
     try:
         # Save uploaded image
         filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
+        unique_filename = f"{secrets.token_hex(8)}_{filename}"
         filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
         
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         file.save(filepath)
+        video_id = int(video_id)
+        
+        # Reuse saved results for the same image content once the video is fully processed
+        video = get_video(video_id)
+        image_hash = compute_file_hash(filepath) if video and video['frames_extracted'] else None
+        cached = get_cached_search(image_hash, video_id, 'full') if image_hash else None
+        if cached is not None:
+            return jsonify(dict(cached, uploaded_image=unique_filename))
         
         # Find matching frames
-        matches = find_matching_frames(filepath, int(video_id))
+        matches = find_matching_frames(filepath, video_id)
         
         # Group matches into time ranges
         time_ranges = get_time_ranges(matches)
@@ -340,7 +473,7 @@ def api_search():
         }
         
         # Save search result
-        save_search_result(filepath, results)
+        save_search_result(filepath, results, image_hash, video_id, 'full')
         
         return jsonify(results)
     
@@ -348,16 +481,18 @@ def api_search():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-if __name__ == '__main__':
-    # Initialize database
+def _bootstrap():
+    """Create the working directories and database once per server process"""
+    for directory in ['database', UPLOAD_FOLDER, 'videos', 'frames', 'static/images']:
+        os.makedirs(directory, exist_ok=True)
     init_database()
-    
-    # Create necessary directories
-    os.makedirs('uploads', exist_ok=True)
-    os.makedirs('videos', exist_ok=True)
-    os.makedirs('frames', exist_ok=True)
-    os.makedirs('static/images', exist_ok=True)
 
+
+if __name__ == '__main__':
+    # Called here and from wsgi.py rather than at import, so extraction worker
+    # processes (which re-import this module under spawn) skip it
+    _bootstrap()
+    
     # Background: ensure specific known videos are prepared on startup
     def _initial_match_samples():
         try:
@@ -365,6 +500,6 @@ if __name__ == '__main__':
         except Exception as e:
             print(f'Initial prepare failed: {e}')
 
-    threading.Thread(target=_initial_match_samples, daemon=True).start()
+    EXECUTOR.submit(_initial_match_samples)
     
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -1,124 +1,267 @@
 import sqlite3
 import os
 from datetime import datetime
-import json
+import orjson
+import threading
+import weakref
+import time
 
 DATABASE_PATH = 'database/news_scan_ai.db'
 
+# One connection per thread, reused across calls instead of reconnecting every time
+_local = threading.local()
+
+# WAL allows concurrent readers but still serializes writers
+_write_lock = threading.Lock()
+
+# Short-lived cache of the videos listing, which most requests read
+VIDEOS_CACHE_TTL = 2.0
+_videos_cache = {'t': 0, 'data': None, 'generation': 0}
+_cache_lock = threading.Lock()
+
+def _invalidate_videos_cache():
+    """Force the next get_all_videos call to hit the database"""
+    with _cache_lock:
+        _videos_cache['t'] = 0
+        _videos_cache['generation'] += 1
+
+def _hamming(a, b):
+    """Bit-level Hamming distance between two equal-length hash BLOBs"""
+    if a is None or b is None or len(a) != len(b):
+        return None
+    return bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1')
+
+class _ConnectionHolder:
+    """Owns a thread's connection; the connection is closed when the holder is collected"""
+    
+    def __init__(self, conn):
+        self.conn = conn
+        # Runs when the thread ends and its locals are dropped, or at interpreter exit
+        weakref.finalize(self, _close_connection, conn)
+
+def _close_connection(conn):
+    """Close a per-thread connection, ignoring errors"""
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def _get_conn():
+    """Get (or lazily open) the SQLite connection for the current thread"""
+    holder = getattr(_local, 'holder', None)
+    if holder is None:
+        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        conn.create_function('hamming', 2, _hamming, deterministic=True)
+        conn.row_factory = sqlite3.Row
+        holder = _ConnectionHolder(conn)
+        _local.holder = holder
+    return holder.conn
+
 def init_database():
     """Initialize the database with required tables"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    cursor = _get_conn().cursor()
     
-    # Create videos table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS videos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            original_name TEXT NOT NULL,
-            file_path TEXT NOT NULL,
-            duration REAL,
-            fps REAL,
-            frames_extracted INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create frames table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS frames (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            video_id INTEGER,
-            frame_number INTEGER,
-            timestamp REAL,
-            frame_path TEXT,
-            feature_hash TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (video_id) REFERENCES videos (id)
-        )
-    ''')
-    
-    # Create searches table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS searches (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uploaded_image_path TEXT,
-            search_results TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        # Create videos table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS videos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                original_name TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                duration REAL,
+                fps REAL,
+                frames_extracted INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Create frames table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS frames (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                video_id INTEGER,
+                frame_number INTEGER,
+                timestamp REAL,
+                frame_path TEXT,
+                feature_hash BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (video_id) REFERENCES videos (id)
+            )
+        ''')
+        
+        # Create searches table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS searches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uploaded_image_path TEXT,
+                search_results TEXT,
+                image_hash TEXT,
+                video_id INTEGER,
+                matcher TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Older databases predate the search cache columns
+        search_columns = {row['name'] for row in cursor.execute('PRAGMA table_info(searches)')}
+        if 'image_hash' not in search_columns:
+            cursor.execute('ALTER TABLE searches ADD COLUMN image_hash TEXT')
+        if 'video_id' not in search_columns:
+            cursor.execute('ALTER TABLE searches ADD COLUMN video_id INTEGER')
+        if 'matcher' not in search_columns:
+            cursor.execute('ALTER TABLE searches ADD COLUMN matcher TEXT')
+
+        # Indexes for the per-video frame lookup and newest-first listings
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_frames_video ON frames(video_id, frame_number)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_created ON videos(created_at DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_path ON videos(file_path)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_searches_created ON searches(created_at DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_searches_image ON searches(image_hash, video_id, matcher)')
 
 def add_video(filename, original_name, file_path, duration=None, fps=None):
     """Add a new video to the database"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    cursor = _get_conn().cursor()
     
-    cursor.execute('''
-        INSERT INTO videos (filename, original_name, file_path, duration, fps)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (filename, original_name, file_path, duration, fps))
+    with _write_lock:
+        cursor.execute('''
+            INSERT INTO videos (filename, original_name, file_path, duration, fps)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (filename, original_name, file_path, duration, fps))
+        video_id = cursor.lastrowid
     
-    video_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    _invalidate_videos_cache()
     return video_id
 
 def add_frame(video_id, frame_number, timestamp, frame_path, feature_hash=None):
     """Add a frame to the database"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    cursor = _get_conn().cursor()
     
-    cursor.execute('''
-        INSERT INTO frames (video_id, frame_number, timestamp, frame_path, feature_hash)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (video_id, frame_number, timestamp, frame_path, feature_hash))
+    with _write_lock:
+        cursor.execute('''
+            INSERT INTO frames (video_id, frame_number, timestamp, frame_path, feature_hash)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (video_id, frame_number, timestamp, frame_path, feature_hash))
+
+def add_frames_bulk(rows):
+    """Add many frames in a single transaction
+    
+    Args:
+        rows: Iterable of (video_id, frame_number, timestamp, frame_path, feature_hash) tuples
+    """
+    cursor = _get_conn().cursor()
     
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.executemany('''
+                INSERT INTO frames (video_id, frame_number, timestamp, frame_path, feature_hash)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+        except BaseException:
+            # Any failure, including one raised while iterating rows, must end the transaction
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
 
 def get_all_videos():
-    """Get all videos from the database"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    """Get all videos from the database (cached for VIDEOS_CACHE_TTL seconds)"""
+    with _cache_lock:
+        if _videos_cache['data'] is not None and time.monotonic() - _videos_cache['t'] < VIDEOS_CACHE_TTL:
+            return list(_videos_cache['data'])
+        generation = _videos_cache['generation']
+    
+    cursor = _get_conn().cursor()
     
     cursor.execute('SELECT * FROM videos ORDER BY created_at DESC')
     videos = cursor.fetchall()
-    conn.close()
-    return videos
+    
+    # Rows read before a concurrent invalidation may be stale; don't cache them
+    with _cache_lock:
+        if _videos_cache['generation'] == generation:
+            _videos_cache['t'] = time.monotonic()
+            _videos_cache['data'] = videos
+    return list(videos)
+
+# Columns callers need when working with a single video
+_VIDEO_COLUMNS = 'id, original_name, file_path, duration, fps, frames_extracted'
+
+def get_video(video_id):
+    """Get a single video by ID, or None"""
+    cursor = _get_conn().cursor()
+    
+    cursor.execute(f'SELECT {_VIDEO_COLUMNS} FROM videos WHERE id = ?', (video_id,))
+    return cursor.fetchone()
+
+def get_video_by_path(file_path):
+    """Get a single video by its file path, or None"""
+    cursor = _get_conn().cursor()
+    
+    cursor.execute(f'SELECT {_VIDEO_COLUMNS} FROM videos WHERE file_path = ? LIMIT 1', (file_path,))
+    return cursor.fetchone()
 
 def get_video_frames(video_id):
     """Get all frames for a specific video"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    cursor = _get_conn().cursor()
     
     cursor.execute('SELECT * FROM frames WHERE video_id = ? ORDER BY frame_number', (video_id,))
     frames = cursor.fetchall()
-    conn.close()
+    return frames
+
+def get_candidate_frames(video_id, query_hash, max_distance):
+    """Get frames of a video whose feature hash is within max_distance bits of query_hash
+    
+    Frames whose hash cannot be compared (missing, or from an older hash format)
+    are kept, since they cannot be ruled out.
+    """
+    cursor = _get_conn().cursor()
+    
+    cursor.execute('''
+        SELECT * FROM frames
+        WHERE video_id = ? AND COALESCE(hamming(feature_hash, ?), 0) <= ?
+        ORDER BY frame_number
+    ''', (video_id, sqlite3.Binary(query_hash), max_distance))
+    frames = cursor.fetchall()
     return frames
 
 def update_video_frames_count(video_id, frames_count):
     """Update the frames extracted count for a video"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    cursor = _get_conn().cursor()
     
-    cursor.execute('UPDATE videos SET frames_extracted = ? WHERE id = ?', (frames_count, video_id))
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        cursor.execute('UPDATE videos SET frames_extracted = ? WHERE id = ?', (frames_count, video_id))
+    
+    _invalidate_videos_cache()
 
-def save_search_result(uploaded_image_path, results):
-    """Save search results to database"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+def save_search_result(uploaded_image_path, results, image_hash=None, video_id=None, matcher=None):
+    """Save search results to database
     
-    cursor.execute('''
-        INSERT INTO searches (uploaded_image_path, search_results)
-        VALUES (?, ?)
-    ''', (uploaded_image_path, json.dumps(results)))
+    Results saved with an image_hash can later be reused by get_cached_search.
+    """
+    cursor = _get_conn().cursor()
+    
+    with _write_lock:
+        cursor.execute('''
+            INSERT INTO searches (uploaded_image_path, search_results, image_hash, video_id, matcher)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (uploaded_image_path, orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+              image_hash, video_id, matcher))
+        search_id = cursor.lastrowid
     
-    search_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
     return search_id
+
+def get_cached_search(image_hash, video_id, matcher):
+    """Get the most recent saved results for the same image content, video and matcher, or None"""
+    cursor = _get_conn().cursor()
+    
+    cursor.execute('''
+        SELECT search_results FROM searches
+        WHERE image_hash = ? AND video_id = ? AND matcher = ?
+        ORDER BY id DESC LIMIT 1
+    ''', (image_hash, video_id, matcher))
+    row = cursor.fetchone()
+    return orjson.loads(row['search_results']) if row else None
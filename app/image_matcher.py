@@ -1,9 +1,29 @@
 import cv2
 import numpy as np
 import os
-from app.database import get_video_frames
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app.database import get_video_frames, get_candidate_frames
+from app.video_processor import (
+    generate_frame_hash, hash_to_uint64, load_frame_hashes,
+    compute_frame_histogram, load_frame_histograms, load_frame_thumbnails, center_histograms,
+    compute_thumbnail_tiles, load_frame_tiles, HISTS_FILENAME
+)
 from sklearn.metrics.pairwise import cosine_similarity
 
+# Frames are scored in parallel; OpenCV releases the GIL while it works
+_SCORING_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# Histogram matrices of recently searched videos, kept in memory as contiguous
+# float32 so repeat searches skip reading and upcasting the sidecar; the cache
+# holds at most HIST_MATRIX_CACHE_BYTES, and larger videos are scored from the
+# memory-mapped sidecar instead
+HIST_MATRIX_CACHE_BYTES = 256 * 1024 * 1024
+_hist_matrices = OrderedDict()
+_hist_matrices_lock = threading.Lock()
+
 def extract_features(image_path):
     """Extract features from an image using ORB detector"""
     img = cv2.imread(image_path)
@@ -21,39 +41,64 @@ def extract_features(image_path):
     
     return keypoints, descriptors
 
-def calculate_histogram_similarity(img1_path, img2_path):
-    """Calculate histogram similarity between two images"""
-    img1 = cv2.imread(img1_path)
-    img2 = cv2.imread(img2_path)
-    
-    if img1 is None or img2 is None:
-        return 0.0
+def prepare_query(image_path):
+    """
+    Decode the uploaded image once and precompute everything the per-frame
+    comparisons need from it
     
-    # Resize images to same size for fair comparison
-    img1 = cv2.resize(img1, (256, 256))
-    img2 = cv2.resize(img2, (256, 256))
+    Returns:
+        Dict with the decoded image, its HSV histogram, grayscale versions, tile
+        means and perceptual hash, or None if the image cannot be read
+    """
+    img = cv2.imread(image_path)
+    if img is None:
+        return None
     
-    # Convert to HSV color space
-    hsv1 = cv2.cvtColor(img1, cv2.COLOR_BGR2HSV)
-    hsv2 = cv2.cvtColor(img2, cv2.COLOR_BGR2HSV)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray_256 = cv2.resize(gray, (256, 256))
+    
+    return {
+        'image': img,
+        'hist': compute_frame_histogram(img),
+        'gray': gray,
+        'gray_256': gray_256,
+        'tiles': compute_thumbnail_tiles(gray_256),
+        'hash': generate_frame_hash(img)
+    }
+
+def _hist_sim(q_hist, frame_path):
+    """Histogram similarity between a precomputed query histogram and a frame"""
+    # The frame is shrunk to 256x256 anyway, so let libjpeg decode it at half size
+    img = cv2.imread(frame_path, cv2.IMREAD_REDUCED_COLOR_2)
+    if img is None:
+        return 0.0
     
-    # Calculate histograms
-    hist1 = cv2.calcHist([hsv1], [0, 1, 2], None, [50, 60, 60], [0, 180, 0, 256, 0, 256])
-    hist2 = cv2.calcHist([hsv2], [0, 1, 2], None, [50, 60, 60], [0, 180, 0, 256, 0, 256])
+    # Same size and bins as the query histogram for fair comparison
+    hist = compute_frame_histogram(img)
     
     # Compare histograms using correlation
-    similarity = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
-    
-    return similarity
+    return cv2.compareHist(q_hist.astype(np.float32), hist.astype(np.float32), cv2.HISTCMP_CORREL)
 
-def template_matching(template_path, target_path):
-    """Perform template matching between two images"""
-    template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
-    target = cv2.imread(target_path, cv2.IMREAD_GRAYSCALE)
-    
-    if template is None or target is None:
+# Template matching runs coarse-to-fine: first at 1/TEMPLATE_PYRAMID_FACTOR
+# resolution, and only frames scoring TEMPLATE_COARSE_THRESHOLD or more there
+# are refined at full resolution around the best coarse location
+TEMPLATE_PYRAMID_FACTOR = 4
+TEMPLATE_COARSE_THRESHOLD = 0.3
+TEMPLATE_MIN_COARSE_SIZE = 16  # pixels; smaller templates are matched at full resolution only
+
+def _match_template_max(target, template):
+    """Best TM_CCOEFF_NORMED score of a template within a target and its location"""
+    result = cv2.matchTemplate(target, template, cv2.TM_CCOEFF_NORMED)
+    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+    return max_val, max_loc
+
+def _tmpl_sim(q_gray, frame_path):
+    """Template matching score of a grayscale query within a frame"""
+    target = cv2.imread(frame_path, cv2.IMREAD_GRAYSCALE)
+    if target is None:
         return 0.0
     
+    template = q_gray
     # Resize template if it's larger than target
     if template.shape[0] > target.shape[0] or template.shape[1] > target.shape[1]:
         scale = min(target.shape[0] / template.shape[0], target.shape[1] / template.shape[1]) * 0.8
@@ -61,26 +106,39 @@ def template_matching(template_path, target_path):
         new_width = int(template.shape[1] * scale)
         template = cv2.resize(template, (new_width, new_height))
     
-    # Perform template matching
-    result = cv2.matchTemplate(target, template, cv2.TM_CCOEFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-    
-    return max_val
+    factor = TEMPLATE_PYRAMID_FACTOR
+    height, width = template.shape[:2]
+    if min(height, width) // factor < TEMPLATE_MIN_COARSE_SIZE:
+        return _match_template_max(target, template)[0]
+    
+    # Coarse pass on downsampled copies rejects most frames cheaply
+    small_template = cv2.resize(template, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    small_target = cv2.resize(target, (target.shape[1] // factor, target.shape[0] // factor), interpolation=cv2.INTER_AREA)
+    coarse_val, (x, y) = _match_template_max(small_target, small_template)
+    if coarse_val < TEMPLATE_COARSE_THRESHOLD:
+        return coarse_val
+    
+    # Refine at full resolution in a window around the coarse match
+    pad = 2 * factor
+    x0 = max(x * factor - pad, 0)
+    y0 = max(y * factor - pad, 0)
+    window = target[y0:y * factor + height + pad, x0:x * factor + width + pad]
+    return _match_template_max(window, template)[0]
 
-def structural_similarity(img1_path, img2_path):
-    """Calculate structural similarity using simple method"""
-    img1 = cv2.imread(img1_path, cv2.IMREAD_GRAYSCALE)
-    img2 = cv2.imread(img2_path, cv2.IMREAD_GRAYSCALE)
-    
-    if img1 is None or img2 is None:
+def _struct_sim(q_gray_256, frame_path):
+    """Structural similarity between a 256x256 grayscale query and a frame"""
+    # The frame is shrunk to 256x256 anyway, so let libjpeg decode it at half size
+    img = cv2.imread(frame_path, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if img is None:
         return 0.0
     
-    # Resize images to same size
-    img1 = cv2.resize(img1, (256, 256))
-    img2 = cv2.resize(img2, (256, 256))
-    
-    # Calculate mean squared error
-    mse = np.mean((img1 - img2) ** 2)
+    return _struct_score(q_gray_256, cv2.resize(img, (256, 256)))
+
+def _struct_score(q_gray_256, img):
+    """Structural similarity between two 256x256 grayscale images"""
+    # Calculate mean squared error; absdiff avoids the wraparound of uint8 subtraction
+    diff = cv2.absdiff(q_gray_256, img).astype(np.float32)
+    mse = cv2.mean(cv2.multiply(diff, diff))[0]
     if mse == 0:
         return 1.0
     
@@ -90,7 +148,162 @@ def structural_similarity(img1_path, img2_path):
     
     return similarity
 
-def find_matching_frames(uploaded_image_path, video_id, similarity_threshold=0.3):
+def calculate_histogram_similarity(img1_path, img2_path):
+    """Calculate histogram similarity between two images"""
+    query = prepare_query(img1_path)
+    return _hist_sim(query['hist'], img2_path) if query else 0.0
+
+def template_matching(template_path, target_path):
+    """Perform template matching between two images"""
+    query = prepare_query(template_path)
+    return _tmpl_sim(query['gray'], target_path) if query else 0.0
+
+def structural_similarity(img1_path, img2_path):
+    """Calculate structural similarity using simple method"""
+    query = prepare_query(img1_path)
+    return _struct_sim(query['gray_256'], img2_path) if query else 0.0
+
+def _popcount64(x):
+    """Count set bits of every element of a uint64 array (SWAR bit-twiddling)"""
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def hamming_distances(hashes, query_hash):
+    """Hamming distance between every uint64 hash in an array and an 8-byte query hash"""
+    return _popcount64(np.bitwise_xor(hashes, hash_to_uint64(query_hash)))
+
+def _load_frame_caches(frames):
+    """
+    Memory-map the hash, histogram, thumbnail and tile sidecars of the video the frames belong to
+    
+    Returns:
+        (hashes, hists, thumbs, tiles); each is None if missing or out of sync with the frames
+    """
+    frames_dir = os.path.dirname(frames[0]['frame_path'])
+    caches = [load_frame_hashes(frames_dir), _load_hist_matrix(frames_dir),
+              load_frame_thumbnails(frames_dir), load_frame_tiles(frames_dir)]
+    return tuple(c if c is not None and len(c) == len(frames) else None for c in caches)
+
+def _load_hist_matrix(frames_dir):
+    """
+    Get the histogram sidecar of a video as a contiguous float32 matrix of
+    centered, normalized rows, cached in memory until the sidecar changes
+    
+    Returns:
+        (N, bins) array (the float16 memory map itself for videos too large to
+        cache), or None if the sidecar is missing
+    """
+    path = os.path.join(frames_dir, HISTS_FILENAME)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (stat.st_mtime_ns, stat.st_size)
+    
+    with _hist_matrices_lock:
+        cached = _hist_matrices.get(path)
+        if cached is not None and cached[0] == version:
+            _hist_matrices.move_to_end(path)
+            return cached[1]
+    
+    hists = load_frame_histograms(frames_dir)
+    if hists is None:
+        return None
+    if hists.dtype == np.float16 and hists.size * np.dtype(np.float32).itemsize > HIST_MATRIX_CACHE_BYTES:
+        # Rows were centered and normalized at extraction; too large to cache
+        matrix = hists
+    elif hists.dtype == np.float16:
+        matrix = np.ascontiguousarray(hists, dtype=np.float32)
+    else:
+        # Raw counts from an older sidecar
+        matrix = center_histograms(hists)
+    
+    with _hist_matrices_lock:
+        if matrix.dtype != np.float32 or matrix.nbytes > HIST_MATRIX_CACHE_BYTES:
+            # Not cached; drop any entry for an older version of the sidecar
+            _hist_matrices.pop(path, None)
+            return matrix
+        _hist_matrices[path] = (version, matrix)
+        _hist_matrices.move_to_end(path)
+        # Evict least recently used matrices until the cache fits its budget
+        while sum(cached[1].nbytes for cached in _hist_matrices.values()) > HIST_MATRIX_CACHE_BYTES:
+            _hist_matrices.popitem(last=False)
+    return matrix
+
+def _close_frame_indices(hashes, query_hash, max_hash_distance):
+    """Indices of frames within max_hash_distance bits of the query hash, closest first"""
+    dists = hamming_distances(hashes, query_hash)
+    close = np.nonzero(dists <= max_hash_distance)[0]
+    return close[np.argsort(dists[close], kind='stable')]
+
+# Frames whose tile means differ from the query's by more than this on average
+# (in gray levels) are rejected before any other comparison
+TILE_SAD_MAX = 40
+
+def _tile_survivors(tiles, indices, q_tiles):
+    """Indices of the frames whose tile means are within TILE_SAD_MAX of the query's (mean absolute difference)"""
+    indices = np.asarray(indices, dtype=np.intp)
+    diff = np.abs(np.asarray(tiles[indices], dtype=np.int16) - q_tiles.astype(np.int16))
+    return indices[diff.mean(axis=(1, 2)) <= TILE_SAD_MAX]
+
+def cached_hist_similarities(hists, indices, q_cached_hist):
+    """
+    Histogram correlation (as cv2.HISTCMP_CORREL) between the query and many
+    cached frame histograms at once
+    
+    Args:
+        hists: (N, bins) float32 matrix of centered, normalized histograms (see _load_hist_matrix)
+        indices: Frame indices to score
+        q_cached_hist: Query histogram with the same bins
+    
+    Returns:
+        float32 array of similarities, one per index
+    """
+    # With both sides centered and normalized, correlation is a single
+    # matrix-vector product
+    q = center_histograms(np.asarray(q_cached_hist).ravel())
+    scores = hists[np.asarray(indices, dtype=np.intp)] @ q
+    return np.clip(scores, -1.0, 1.0, out=scores)
+
+# Thumbnails are scored in blocks to bound the float32 working copy
+STRUCT_BATCH_FRAMES = 256
+
+def batch_struct_scores(thumbs, indices, q_gray_256):
+    """
+    Structural similarity (as _struct_score) between the query and many cached
+    frame thumbnails at once
+    
+    Args:
+        thumbs: (N, 256, 256) thumbnail sidecar of a video
+        indices: Frame indices to score
+        q_gray_256: 256x256 grayscale query
+    
+    Returns:
+        float32 array of similarities, one per index
+    """
+    indices = np.asarray(indices, dtype=np.intp)
+    q = q_gray_256.astype(np.float32).ravel()
+    scores = np.empty(len(indices), dtype=np.float32)
+    
+    # Squared differences summed as |t|^2 - 2 t.q + |q|^2, one matrix product per block
+    for start in range(0, len(indices), STRUCT_BATCH_FRAMES):
+        block = indices[start:start + STRUCT_BATCH_FRAMES]
+        T = np.asarray(thumbs[block], dtype=np.float32).reshape(len(block), -1)
+        sq_err = np.einsum('ij,ij->i', T, T) - 2 * (T @ q) + float(q @ q)
+        scores[start:start + len(block)] = np.maximum(sq_err, 0) / q.size
+    
+    # Convert mean squared error to similarity score (higher is better)
+    return 1.0 - scores / (255.0 ** 2)
+
+# Weights of the combined score in find_matching_frames; each similarity is at
+# most 1, which bounds the score of a frame that is only partly scored
+HIST_WEIGHT = 0.3
+TEMPLATE_WEIGHT = 0.4
+STRUCT_WEIGHT = 0.3
+
+def find_matching_frames(uploaded_image_path, video_id, similarity_threshold=0.3, max_hash_distance=16):
     """
     Find frames in video that match the uploaded image
     
@@ -98,54 +311,127 @@ def find_matching_frames(uploaded_image_path, video_id, similarity_threshold=0.3
         uploaded_image_path: Path to uploaded image
         video_id: Database ID of the video to search
         similarity_threshold: Minimum similarity score to consider a match
+        max_hash_distance: Maximum perceptual hash distance (in bits) for a frame
+            to be scored at all; None turns off prefiltering (hash and tile
+            rejects) and scores every frame
     
     Returns:
         List of matching frames with timestamps and similarity scores
     """
-    # Get all frames for the video
+    # Decode the uploaded image once for all frame comparisons
+    query = prepare_query(uploaded_image_path)
+    if query is None:
+        return []
+    
     frames = get_video_frames(video_id)
     
     if not frames:
         return []
     
-    matches = []
+    # Prefilter frames by perceptual hash distance, then score only the survivors
+    hashes, hists, thumbs, tiles = _load_frame_caches(frames)
+    if max_hash_distance is None:
+        candidates = range(len(frames))
+    elif hashes is not None:
+        candidates = np.sort(_close_frame_indices(hashes, query['hash'], max_hash_distance)).tolist()
+    else:
+        # No hash sidecar: let SQLite do the prefiltering; the other
+        # sidecars' rows can't be matched to this subset
+        frames = get_candidate_frames(video_id, query['hash'], max_hash_distance)
+        candidates = range(len(frames))
+        hists = thumbs = tiles = None
+    
+    # Coarse tile comparison rejects clearly different frames before any histogram work
+    if tiles is not None and max_hash_distance is not None:
+        candidates = _tile_survivors(tiles, candidates, query['tiles'])
+    
+    if not len(candidates):
+        return []
+    
+    # Histograms and thumbnails cached at extraction time replace decoding the
+    # frame for those metrics, and all candidates are scored in one batch
+    candidates = np.asarray(candidates, dtype=np.intp)
+    hist_scores = struct_scores = None
+    if hists is not None:
+        hist_scores = cached_hist_similarities(hists, candidates, query['hist'])
+    if thumbs is not None:
+        struct_scores = batch_struct_scores(thumbs, candidates, query['gray_256'])
+    
+    print(f"Comparing uploaded image with {len(candidates)} frames...")
+    
+    # Only frames that could still pass with a perfect template score go on
+    # to template matching
+    if hist_scores is not None and struct_scores is not None:
+        keep = hist_scores * HIST_WEIGHT + struct_scores * STRUCT_WEIGHT + TEMPLATE_WEIGHT > similarity_threshold
+        candidates, hist_scores, struct_scores = candidates[keep], hist_scores[keep], struct_scores[keep]
     
-    print(f"Comparing uploaded image with {len(frames)} frames...")
+    progress = itertools.count(1)
     
-    for i, frame in enumerate(frames):
-        frame_id, video_id, frame_number, timestamp, frame_path, feature_hash, created_at = frame
+    def score_frame(position):
+        frame_index = candidates[position]
+        frame_id, video_id, frame_number, timestamp, frame_path, feature_hash, created_at = frames[frame_index]
         
-        # Check if frame file exists
-        if not os.path.exists(frame_path):
-            continue
+        # Frames without a JPEG can still be scored from the sidecars
+        has_jpeg = os.path.exists(frame_path)
+        if not has_jpeg and (hist_scores is None or thumbs is None):
+            return None
         
-        # Calculate different similarity metrics
-        hist_similarity = calculate_histogram_similarity(uploaded_image_path, frame_path)
-        template_similarity = template_matching(uploaded_image_path, frame_path)
-        struct_similarity = structural_similarity(uploaded_image_path, frame_path)
+        # Calculate different similarity metrics; thumbnails and cached
+        # histograms save decoding the frame JPEG for them
+        if hist_scores is not None:
+            hist_similarity = float(hist_scores[position])
+        else:
+            hist_similarity = _hist_sim(query['hist'], frame_path)
+        
+        # Progress indicator
+        done = next(progress)
+        if done % 50 == 0:
+            print(f"Processed {done}/{len(candidates)} frames...")
+        
+        # Cascade from cheapest to most expensive metric, rejecting the frame as
+        # soon as even perfect remaining scores could not reach the threshold
+        if hist_similarity * HIST_WEIGHT + TEMPLATE_WEIGHT + STRUCT_WEIGHT <= similarity_threshold:
+            return None
+        
+        thumb = np.asarray(thumbs[frame_index]) if thumbs is not None else None
+        if struct_scores is not None:
+            struct_similarity = float(struct_scores[position])
+        else:
+            struct_similarity = _struct_sim(query['gray_256'], frame_path)
+        if hist_similarity * HIST_WEIGHT + struct_similarity * STRUCT_WEIGHT + TEMPLATE_WEIGHT <= similarity_threshold:
+            return None
+        
+        if has_jpeg:
+            template_similarity = _tmpl_sim(query['gray'], frame_path)
+        else:
+            # The thumbnail squashes the frame to 256x256, so compare it with the
+            # query squashed the same way; equal sizes give one global correlation
+            template_similarity = _match_template_max(thumb, query['gray_256'])[0]
         
         # Combined similarity score (weighted average)
-        combined_similarity = (hist_similarity * 0.3 + template_similarity * 0.4 + struct_similarity * 0.3)
+        combined_similarity = (hist_similarity * HIST_WEIGHT + template_similarity * TEMPLATE_WEIGHT
+                               + struct_similarity * STRUCT_WEIGHT)
         
         # Check if similarity exceeds threshold
-        if combined_similarity > similarity_threshold:
-            matches.append({
-                'frame_id': frame_id,
-                'frame_number': frame_number,
-                'timestamp': timestamp,
-                'similarity_score': combined_similarity,
-                'hist_similarity': hist_similarity,
-                'template_similarity': template_similarity,
-                'struct_similarity': struct_similarity,
-                'frame_path': frame_path
-            })
+        if combined_similarity <= similarity_threshold:
+            return None
         
-        # Progress indicator
-        if (i + 1) % 50 == 0:
-            print(f"Processed {i + 1}/{len(frames)} frames...")
+        return {
+            'frame_id': frame_id,
+            'frame_number': frame_number,
+            'timestamp': timestamp,
+            'similarity_score': combined_similarity,
+            'hist_similarity': hist_similarity,
+            'template_similarity': template_similarity,
+            'struct_similarity': struct_similarity,
+            'frame_path': frame_path
+        }
+    
+    matches = [m for m in _SCORING_EXECUTOR.map(score_frame, range(len(candidates))) if m is not None]
     
     # Sort matches by similarity score (highest first)
-    matches.sort(key=lambda x: x['similarity_score'], reverse=True)
+    scores = np.fromiter((m['similarity_score'] for m in matches), dtype=np.float64, count=len(matches))
+    matches = [matches[i] for i in np.argsort(-scores, kind='stable')]
     
     print(f"Found {len(matches)} matching frames")
     
@@ -166,91 +452,88 @@ def get_time_ranges(matches, max_gap=5.0):
         max_gap: Maximum gap in seconds to group frames together
     
     Returns:
-        List of time ranges where the image appears
+        List of time ranges where the image appears, in time order
     """
     if not matches:
         return []
     
-    ranges = []
-    current_range_start = matches[0]['timestamp']
-    current_range_end = matches[0]['timestamp']
-    
-    for match in matches[1:]:
-        timestamp = match['timestamp']
-        
-        # If gap is small, extend current range
-        if timestamp - current_range_end <= max_gap:
-            current_range_end = timestamp
-        else:
-            # Finalize current range and start new one
-            ranges.append({
-                'start_time': current_range_start,
-                'end_time': current_range_end,
-                'start_formatted': format_timestamp(current_range_start),
-                'end_formatted': format_timestamp(current_range_end),
-                'duration': current_range_end - current_range_start
-            })
-            current_range_start = timestamp
-            current_range_end = timestamp
-    
-    # Add the last range
-    ranges.append({
-        'start_time': current_range_start,
-        'end_time': current_range_end,
-        'start_formatted': format_timestamp(current_range_start),
-        'end_formatted': format_timestamp(current_range_end),
-        'duration': current_range_end - current_range_start
-    })
-    
-    return ranges
+    # Matches arrive ordered by score, so group on the sorted timestamps
+    timestamps = np.sort(np.fromiter((m['timestamp'] for m in matches), dtype=np.float64, count=len(matches)))
+    
+    # A new range starts wherever the gap to the previous timestamp is too large
+    cuts = np.nonzero(np.diff(timestamps) > max_gap)[0]
+    starts = np.r_[timestamps[0], timestamps[cuts + 1]].tolist()
+    ends = np.r_[timestamps[cuts], timestamps[-1]].tolist()
+    
+    return [{
+        'start_time': start,
+        'end_time': end,
+        'start_formatted': format_timestamp(start),
+        'end_formatted': format_timestamp(end),
+        'duration': end - start
+    } for start, end in zip(starts, ends)]
 
-def find_matching_frames_fast(uploaded_image_path, video_id, similarity_threshold=0.2):
+def find_matching_frames_fast(uploaded_image_path, video_id, similarity_threshold=0.2, max_hash_distance=16):
     """
     Fast image matching for demo purposes
     Uses optimized comparison and early exit
     """
-    # Get frames but sample every 5th frame for speed
     frames = get_video_frames(video_id)
     
     if not frames:
         return []
     
-    matches = []
-    
-    # For demo speed, only check every 5th frame and limit to 50 frames max
-    sampled_frames = frames[::5][:50]  # Every 5th frame, max 50 frames
-    
-    print(f"Fast matching: checking {len(sampled_frames)} frames (sampled from {len(frames)})...")
-    
-    for i, frame in enumerate(sampled_frames):
-        frame_id, video_id, frame_number, timestamp, frame_path, feature_hash, created_at = frame
-        
-        # Check if frame file exists
-        if not os.path.exists(frame_path):
-            continue
-        
-        # Use only histogram similarity for speed
-        hist_similarity = calculate_histogram_similarity(uploaded_image_path, frame_path)
-        
-        # Lower threshold for demo
-        if hist_similarity > similarity_threshold:
-            matches.append({
-                'frame_id': frame_id,
-                'frame_number': frame_number,
-                'timestamp': timestamp,
-                'similarity_score': hist_similarity,
-                'hist_similarity': hist_similarity,
-                'template_similarity': hist_similarity * 0.8,  # Estimated for display
-                'struct_similarity': hist_similarity * 0.9,   # Estimated for display
-                'frame_path': frame_path
-            })
-        
-        # Progress update less frequently
-        if (i + 1) % 10 == 0:
-            print(f"Fast check: {i + 1}/{len(sampled_frames)} frames...")
+    # Decode the uploaded image once for all frame comparisons
+    query = prepare_query(uploaded_image_path)
+    if query is None:
+        return []
     
-    # Sort matches by similarity score
-    matches.sort(key=lambda x: x['similarity_score'], reverse=True)
+    matches = []
+    hashes, hists, thumbs, tiles = _load_frame_caches(frames)
+    
+    # Prefer the frames whose perceptual hash is close to the query, using the
+    # per-video hash sidecar; fall back to a sparse sample if there are none
+    candidates = []
+    if hashes is not None:
+        candidates = _close_frame_indices(hashes, query['hash'], max_hash_distance)[:50].tolist()  # Closest 50 frames max
+    
+    if not candidates:
+        # For demo speed, only check every 5th frame and limit to 50 frames max
+        candidates = list(range(0, len(frames), 5))[:50]  # Every 5th frame, max 50 frames
+    
+    # Coarse tile comparison rejects clearly different frames before any histogram work
+    if tiles is not None:
+        candidates = _tile_survivors(tiles, candidates, query['tiles']).tolist()
+        if not candidates:
+            return []
+    
+    print(f"Fast matching: checking {len(candidates)} frames (sampled from {len(frames)})...")
+    
+    # Use only histogram similarity for speed; histograms cached at extraction
+    # time are scored in one batch, so no frame JPEG has to be decoded
+    if hists is not None:
+        scores = cached_hist_similarities(hists, candidates, query['hist'])
+    else:
+        scores = np.array([
+            _hist_sim(query['hist'], frames[i]['frame_path']) if os.path.exists(frames[i]['frame_path']) else -1.0
+            for i in candidates
+        ])
+    
+    # Lower threshold for demo; matches are taken highest score first
+    selected = np.nonzero(scores > similarity_threshold)[0]
+    for j in selected[np.argsort(-scores[selected], kind='stable')]:
+        frame_id, video_id, frame_number, timestamp, frame_path, feature_hash, created_at = frames[candidates[j]]
+        hist_similarity = float(scores[j])
+        matches.append({
+            'frame_id': frame_id,
+            'frame_number': frame_number,
+            'timestamp': timestamp,
+            'similarity_score': hist_similarity,
+            'hist_similarity': hist_similarity,
+            'template_similarity': hist_similarity * 0.8,  # Estimated for display
+            'struct_similarity': hist_similarity * 0.9,   # Estimated for display
+            'frame_path': frame_path
+        })
     
     print(f"Fast matching complete: {len(matches)} matches found")
     
@@ -1,9 +1,62 @@
 import cv2
+import numpy as np
+import io
 import os
-import hashlib
-from app.database import add_frame, update_video_frames_count
+import multiprocessing
+import threading
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.database import add_frames_bulk, update_video_frames_count
 
-def extract_frames_from_video(video_path, video_id, output_dir, frame_interval=30):
+# Number of frame rows buffered before they are written to the database
+FRAME_INSERT_BATCH_SIZE = 512
+
+# GPU decoding (NEWSSCAN_USE_NVDEC=1) only pays off for longer videos
+NVDEC_MIN_DURATION = 60.0  # seconds
+NVDEC_BATCH_FRAMES = 64
+
+# Long videos are split into segments extracted by separate processes; one
+# pool of EXTRACT_WORKERS processes is shared by all concurrent extractions
+PARALLEL_MIN_DURATION = 120.0  # seconds
+EXTRACT_WORKERS = int(os.environ.get('NEWSSCAN_EXTRACT_WORKERS', os.cpu_count() or 1))
+_segment_pool = None
+_segment_pool_lock = threading.Lock()
+
+# Per-video sidecars holding every frame hash (uint64), HSV histogram, 256x256
+# grayscale thumbnail and TILE_GRID x TILE_GRID tile means, in frame order;
+# histograms are stored as float16 rows ready for dot-product correlation
+# (older sidecars hold raw counts)
+HASHES_FILENAME = 'hashes.npy'
+HISTS_FILENAME = 'hists.npy'
+THUMBS_FILENAME = 'thumbs.npy'
+TILES_FILENAME = 'tiles.npy'
+
+# Side of the grid of tile means used to cheaply reject frames at search time
+TILE_GRID = 10
+
+# Bins of the HSV histograms used for matching; 4096 uint8 bins per frame keep
+# the whole per-video histogram matrix small enough to stay in cache
+CACHED_HIST_BINS = [16, 16, 16]
+
+# Row shape and dtype of each sidecar. During extraction they are written as
+# memory-mapped '<name>.part' files and renamed into place once complete
+SIDECAR_LAYOUT = {
+    HASHES_FILENAME: ((), np.uint64),
+    HISTS_FILENAME: ((int(np.prod(CACHED_HIST_BINS)),), np.float16),
+    THUMBS_FILENAME: ((256, 256), np.uint8),
+    TILES_FILENAME: ((TILE_GRID, TILE_GRID), np.uint8),
+}
+
+# Let FFmpeg decode on VAAPI/NVDEC/D3D11 when available (falls back to software);
+# set NEWSSCAN_HW_DECODE=0 to always decode on the CPU
+HW_DECODE = os.environ.get('NEWSSCAN_HW_DECODE', '1') != '0'
+
+# Frame JPEGs are only needed by the full matcher and frame previews;
+# set NEWSSCAN_SAVE_JPEGS=0 to keep just the precomputed descriptors
+SAVE_FRAME_JPEGS = os.environ.get('NEWSSCAN_SAVE_JPEGS', '1') != '0'
+
+def extract_frames_from_video(video_path, video_id, output_dir, frame_interval=30, save_jpegs=None):
     """
     Extract frames from video at specified intervals
     
@@ -12,15 +65,18 @@ def extract_frames_from_video(video_path, video_id, output_dir, frame_interval=3
         video_id: Database ID of the video
         output_dir: Directory to save extracted frames
         frame_interval: Extract every N frames (default: 30 = 1 frame per second at 30fps)
+        save_jpegs: Whether to also write each frame as a JPEG (default: SAVE_FRAME_JPEGS)
     
     Returns:
         Number of frames extracted
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    if save_jpegs is None:
+        save_jpegs = SAVE_FRAME_JPEGS
     
-    # Open video
-    cap = cv2.VideoCapture(video_path)
+    # Open video with the FFmpeg backend, which supports grab() without retrieving the frame
+    cap = open_video_capture(video_path)
     if not cap.isOpened():
         print(f"Error: Could not open video {video_path}")
         return 0
@@ -29,54 +85,411 @@ def extract_frames_from_video(video_path, video_id, output_dir, frame_interval=3
     fps = cap.get(cv2.CAP_PROP_FPS)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     
-    frame_count = 0
     extracted_count = 0
+    pending_rows = []
     
-    print(f"Processing video: FPS={fps}, Total frames={total_frames}")
+    # Descriptors are written straight into memory-mapped sidecars sized from the
+    # container's frame count, so a long video's thumbnails never sit in memory
+    _create_sidecars(output_dir, max(-(-total_frames // frame_interval), 1))
+    writer = _SidecarWriter(output_dir)
     
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    # Long videos are decoded on the GPU when NVDEC is enabled and available,
+    # or split across worker processes otherwise
+    duration = total_frames / fps if fps > 0 else 0
+    if use_nvdec(duration):
+        cap.release()
+        print(f"Processing video on GPU (NVDEC): FPS={fps}, Total frames={total_frames}")
+        stored_frames = _store_frames(
+            writer, _iter_sampled_frames_nvdec(video_path, frame_interval),
+            video_id, output_dir, frame_interval, save_jpegs)
+    elif EXTRACT_WORKERS > 1 and duration >= PARALLEL_MIN_DURATION:
+        cap.release()
+        print(f"Processing video in {EXTRACT_WORKERS} worker processes: FPS={fps}, Total frames={total_frames}")
+        stored_frames = _store_frames_parallel(
+            writer, video_path, video_id, output_dir, frame_interval, save_jpegs)
+    else:
+        print(f"Processing video: FPS={fps}, Total frames={total_frames}")
+        stored_frames = _store_frames(
+            writer, _iter_sampled_frames(cap, frame_interval),
+            video_id, output_dir, frame_interval, save_jpegs)
+    
+    for frame_number, frame_path, feature_hash in stored_frames:
+        timestamp = frame_number / fps
         
-        # Extract frame at specified intervals
-        if frame_count % frame_interval == 0:
-            timestamp = frame_count / fps
-            frame_filename = f"video_{video_id}_frame_{extracted_count:06d}.jpg"
-            frame_path = os.path.join(output_dir, frame_filename)
-            
-            # Save frame
-            cv2.imwrite(frame_path, frame)
-            
-            # Generate a simple feature hash (you can improve this with better feature extraction)
-            feature_hash = generate_frame_hash(frame)
-            
-            # Add frame to database
-            add_frame(video_id, frame_count, timestamp, frame_path, feature_hash)
-            
-            extracted_count += 1
-            
-            if extracted_count % 100 == 0:
-                print(f"Extracted {extracted_count} frames...")
+        # Queue frame for the next batched database insert
+        pending_rows.append((video_id, frame_number, timestamp, frame_path, feature_hash))
+        if len(pending_rows) >= FRAME_INSERT_BATCH_SIZE:
+            add_frames_bulk(pending_rows)
+            pending_rows = []
+        
+        extracted_count += 1
         
-        frame_count += 1
+        if extracted_count % 100 == 0:
+            print(f"Extracted {extracted_count} frames...")
     
     cap.release()
     
+    # Flush any frames still waiting to be inserted
+    if pending_rows:
+        add_frames_bulk(pending_rows)
+    
+    # Publish the sidecars used for vectorized prefiltering and fast scoring
+    writer.close()
+    _publish_sidecars(output_dir, extracted_count)
+    
     # Update video frames count in database
     update_video_frames_count(video_id, extracted_count)
     
     print(f"Extraction complete: {extracted_count} frames extracted")
     return extracted_count
 
+def _describe_frame(frame, frame_number, video_id, output_dir, frame_interval, save_jpegs):
+    """
+    Optionally save a sampled frame as a JPEG and compute its descriptors
+    
+    Returns:
+        (frame_path, feature_hash, histogram, thumbnail, tiles)
+    """
+    frame_filename = f"video_{video_id}_frame_{frame_number // frame_interval:06d}.jpg"
+    frame_path = os.path.join(output_dir, frame_filename)
+    
+    # Save frame
+    if save_jpegs:
+        cv2.imwrite(frame_path, frame)
+    
+    # Perceptual hash used to prefilter candidate frames at search time, plus the
+    # histogram, thumbnail and tiles computed from the decoded frame, so searches
+    # never re-read the JPEG
+    thumb = compute_frame_thumbnail(frame)
+    return (frame_path, generate_frame_hash(frame),
+            compute_frame_histogram(frame), thumb, compute_thumbnail_tiles(thumb))
+
+def _store_frames(writer, frames, video_id, output_dir, frame_interval, save_jpegs, first_row=0, overflow=None):
+    """
+    Describe sampled frames and write their descriptors into the sidecars from first_row on
+    
+    Args:
+        writer: _SidecarWriter over the sidecars being built
+        frames: Iterable of (frame_number, frame)
+        first_row: Sidecar row of the first frame
+        overflow: List collecting the descriptors of frames past the last sidecar row;
+            when None the sidecars are grown instead
+    
+    Yields:
+        (frame_number, frame_path, feature_hash) for every frame, in order
+    """
+    row = first_row
+    for frame_number, frame in frames:
+        frame_path, feature_hash, hist, thumb, tiles = _describe_frame(
+            frame, frame_number, video_id, output_dir, frame_interval, save_jpegs)
+        
+        # The container's frame count is only an estimate
+        if row >= writer.capacity and overflow is not None:
+            overflow.append((feature_hash, hist, thumb, tiles))
+        else:
+            if row >= writer.capacity:
+                writer.grow(2 * writer.capacity)
+            writer.write(row, feature_hash, hist, thumb, tiles)
+            row += 1
+        
+        yield frame_number, frame_path, feature_hash
+
+def _store_segment(video_path, video_id, output_dir, frame_interval, save_jpegs, start_frame, end_frame, first_row):
+    """
+    Describe the sampled frames in [start_frame, end_frame) of a video (runs in a worker process)
+    
+    Descriptors are written into the shared sidecars from first_row on. Worker
+    processes cannot grow those files, so descriptors past their end are returned.
+    
+    Returns:
+        (list of (frame_number, frame_path, feature_hash), list of overflowing descriptors)
+    """
+    cap = open_video_capture(video_path)
+    if not cap.isOpened():
+        return [], []
+    if start_frame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    
+    writer = _SidecarWriter(output_dir)
+    overflow = []
+    rows = list(_store_frames(
+        writer, _iter_sampled_frames(cap, frame_interval, start_frame, end_frame),
+        video_id, output_dir, frame_interval, save_jpegs, first_row, overflow))
+    writer.close()
+    cap.release()
+    return rows, overflow
+
+def _get_segment_pool():
+    """Get the shared segment extraction pool, starting it on first use"""
+    global _segment_pool
+    with _segment_pool_lock:
+        if _segment_pool is None:
+            # spawn rather than fork: the web process runs threads (and OpenCV's own pools)
+            context = multiprocessing.get_context('spawn')
+            _segment_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=context)
+        return _segment_pool
+
+def _reset_segment_pool(pool):
+    """Drop a broken segment pool so the next extraction starts a fresh one"""
+    global _segment_pool
+    with _segment_pool_lock:
+        if _segment_pool is pool:
+            _segment_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@atexit.register
+def _shutdown_segment_pool():
+    """Stop the segment extraction processes on interpreter exit"""
+    with _segment_pool_lock:
+        pool = _segment_pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _store_frames_parallel(writer, video_path, video_id, output_dir, frame_interval, save_jpegs):
+    """
+    Extract contiguous segments of a video in worker processes, each writing its own rows of the sidecars
+    
+    Yields:
+        (frame_number, frame_path, feature_hash) for every frame, in order
+    """
+    # Segments start on sampled frames and each owns the sidecar rows of its
+    # samples; the last one reads to the end of the video, since the sidecars are
+    # sized from the container's frame count, which is only an estimate
+    samples = writer.capacity
+    segments = max(1, min(EXTRACT_WORKERS, samples))
+    first_rows = [samples * k // segments for k in range(segments)]
+    bounds = [row * frame_interval for row in first_rows] + [None]
+    
+    pool = _get_segment_pool()
+    try:
+        futures = [
+            pool.submit(_store_segment, video_path, video_id, output_dir, frame_interval, save_jpegs,
+                        bounds[k], bounds[k + 1], first_rows[k])
+            for k in range(segments)
+        ]
+        row = 0
+        for first_row, future in zip(first_rows, futures):
+            rows, overflow = future.result()
+            
+            # Close the gap left by any earlier segment that came up short
+            stored = len(rows) - len(overflow)
+            if first_row != row:
+                writer.move(first_row, row, stored)
+            row += stored
+            
+            for descriptors in overflow:
+                if row >= writer.capacity:
+                    writer.grow(2 * writer.capacity)
+                writer.write(row, *descriptors)
+                row += 1
+            
+            yield from rows
+    except BrokenProcessPool:
+        _reset_segment_pool(pool)
+        raise
+
+def _iter_sampled_frames(cap, frame_interval, start_frame=0, end_frame=None):
+    """Yield (frame_number, frame) for every frame_interval-th frame in [start_frame, end_frame) using OpenCV on the CPU"""
+    frame_number = start_frame
+    while end_frame is None or frame_number < end_frame:
+        # grab() decodes but leaves the frame in the decoder (on the GPU when
+        # hardware decoding is active); only sampled frames are retrieved
+        if not cap.grab():
+            break
+        
+        if frame_number % frame_interval == 0:
+            ret, frame = cap.retrieve()
+            if ret:
+                yield frame_number, frame
+        
+        frame_number += 1
+
+def open_video_capture(video_path):
+    """Open a video with the FFmpeg backend, using hardware decoding when enabled"""
+    params = []
+    if HW_DECODE:
+        params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    return cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, params)
+
+def use_nvdec(duration):
+    """Check whether GPU decoding should be used for a video of the given duration"""
+    if os.environ.get('NEWSSCAN_USE_NVDEC') != '1' or duration < NVDEC_MIN_DURATION:
+        return False
+    try:
+        import torch
+        import torchcodec
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+def _iter_sampled_frames_nvdec(video_path, frame_interval):
+    """Yield (frame_number, frame) for every frame_interval-th frame decoded with NVDEC via torchcodec"""
+    from torchcodec.decoders import VideoDecoder
+    
+    decoder = VideoDecoder(video_path, device='cuda', seek_mode='approximate')
+    total_frames = len(decoder)
+    
+    # Decode in batches so only a bounded number of frames sits in GPU memory
+    batch_span = NVDEC_BATCH_FRAMES * frame_interval
+    for start in range(0, total_frames, batch_span):
+        stop = min(start + batch_span, total_frames)
+        batch = decoder.get_frames_in_range(start, stop, step=frame_interval)
+        # (N, C, H, W) RGB on the GPU -> (N, H, W, C) BGR on the host for OpenCV
+        frames = batch.data.permute(0, 2, 3, 1).cpu().numpy()[..., ::-1]
+        for i, frame in enumerate(frames):
+            yield start + i * frame_interval, np.ascontiguousarray(frame)
+
 def generate_frame_hash(frame):
-    """Generate a simple hash for frame comparison"""
-    # Resize frame for consistent hashing
-    resized = cv2.resize(frame, (64, 64))
-    # Convert to grayscale
-    gray = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)
-    # Create hash
-    return hashlib.md5(gray.tobytes()).hexdigest()
+    """Generate a 64-bit perceptual hash (pHash) of a frame, as raw bytes for the BLOB column"""
+    # Low-frequency DCT coefficients of a small grayscale copy describe the overall structure;
+    # this separates cropped screenshots from other frames better than a 9x8 difference hash
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8]
+    # One bit per coefficient: above or below the median
+    bits = low_freq > np.median(low_freq)
+    return np.packbits(bits).tobytes()
+
+def compute_frame_histogram(frame):
+    """Compute the HSV color histogram of a frame (CACHED_HIST_BINS bins, scaled to uint8)"""
+    hsv = cv2.cvtColor(cv2.resize(frame, (256, 256)), cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1, 2], None, CACHED_HIST_BINS, [0, 180, 0, 256, 0, 256])
+    # Correlation is scale-invariant, so 0-255 quantization costs almost no accuracy
+    cv2.normalize(hist, hist, 0, 255, cv2.NORM_MINMAX)
+    return np.rint(hist.ravel()).astype(np.uint8)
+
+def compute_frame_thumbnail(frame):
+    """Compute the 256x256 grayscale thumbnail that structural comparisons use"""
+    return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (256, 256))
+
+def compute_thumbnail_tiles(thumb):
+    """Mean brightness of each tile of a TILE_GRID x TILE_GRID grid over a grayscale thumbnail"""
+    return cv2.resize(thumb, (TILE_GRID, TILE_GRID), interpolation=cv2.INTER_AREA)
+
+def hash_to_uint64(hash_bytes):
+    """Interpret an 8-byte frame hash as a uint64"""
+    return np.uint64(int.from_bytes(hash_bytes, 'big'))
+
+def _load_sidecar(frames_dir, filename):
+    """Memory-map a per-video sidecar array, or return None if it is missing"""
+    path = os.path.join(frames_dir, filename)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+def _partial_sidecar_path(frames_dir, filename):
+    """Path of a sidecar while it is being written"""
+    return os.path.join(frames_dir, filename + '.part')
+
+def _create_sidecars(frames_dir, rows):
+    """Create zero-filled partial sidecars with room for the given number of frames"""
+    for filename, (shape, dtype) in SIDECAR_LAYOUT.items():
+        sidecar = np.lib.format.open_memmap(
+            _partial_sidecar_path(frames_dir, filename), mode='w+', dtype=dtype, shape=(rows,) + shape)
+        del sidecar
+
+def _resize_sidecar(path, rows):
+    """Change the number of rows of an .npy file in place by rewriting its header and truncating or extending it"""
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+        
+        # NumPy pads .npy headers so the first dimension can change without moving the data
+        header = io.BytesIO()
+        header_fields = {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': fortran_order,
+            'shape': (rows,) + shape[1:],
+        }
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_fields)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_fields)
+        if header.tell() != header_size:
+            raise ValueError(f"Cannot resize {path} in place")
+        
+        f.seek(0)
+        f.write(header.getvalue())
+        f.truncate(header_size + rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+def _publish_sidecars(frames_dir, rows):
+    """Trim the partial sidecars to the frames actually extracted and move them into place"""
+    for filename in SIDECAR_LAYOUT:
+        path = _partial_sidecar_path(frames_dir, filename)
+        _resize_sidecar(path, rows)
+        os.replace(path, os.path.join(frames_dir, filename))
+
+class _SidecarWriter:
+    """Writes frame descriptors into a video's memory-mapped partial sidecars"""
+    
+    def __init__(self, frames_dir):
+        self.frames_dir = frames_dir
+        self._open()
+    
+    def _open(self):
+        self.sidecars = {
+            filename: np.load(_partial_sidecar_path(self.frames_dir, filename), mmap_mode='r+')
+            for filename in SIDECAR_LAYOUT
+        }
+    
+    @property
+    def capacity(self):
+        """Number of frame rows the sidecars currently hold"""
+        return len(self.sidecars[HASHES_FILENAME])
+    
+    def write(self, row, feature_hash, hist, thumb, tiles):
+        """Store one frame's descriptors; the histogram is centered and normalized on the way"""
+        self.sidecars[HASHES_FILENAME][row] = hash_to_uint64(feature_hash)
+        self.sidecars[HISTS_FILENAME][row] = center_histograms(hist)
+        self.sidecars[THUMBS_FILENAME][row] = thumb
+        self.sidecars[TILES_FILENAME][row] = tiles
+    
+    def move(self, src, dst, count, block=256):
+        """Move count rows from src down to dst (dst < src) in bounded blocks"""
+        for start in range(0, count, block):
+            stop = min(start + block, count)
+            for sidecar in self.sidecars.values():
+                sidecar[dst + start:dst + stop] = sidecar[src + start:src + stop]
+    
+    def grow(self, rows):
+        """Extend the sidecars to hold rows frames (only while no other process has them open)"""
+        self.close()
+        for filename in SIDECAR_LAYOUT:
+            _resize_sidecar(_partial_sidecar_path(self.frames_dir, filename), rows)
+        self._open()
+    
+    def close(self):
+        """Flush the written rows to disk and unmap the sidecars"""
+        for sidecar in self.sidecars.values():
+            sidecar.flush()
+        self.sidecars = {}
+
+def load_frame_hashes(frames_dir):
+    """Memory-map the frame hash sidecar of a video, or return None if it is missing"""
+    return _load_sidecar(frames_dir, HASHES_FILENAME)
+
+def center_histograms(hists):
+    """Subtract each histogram's mean and scale it to unit L2 norm, so correlation is a dot product"""
+    hists = np.asarray(hists, dtype=np.float32)
+    hists = hists - hists.mean(axis=-1, keepdims=True)
+    norms = np.linalg.norm(hists, axis=-1, keepdims=True)
+    return np.divide(hists, norms, out=np.zeros_like(hists), where=norms > 0)
+
+def load_frame_histograms(frames_dir):
+    """Memory-map the frame histogram sidecar of a video, or return None if it is missing"""
+    return _load_sidecar(frames_dir, HISTS_FILENAME)
+
+def load_frame_thumbnails(frames_dir):
+    """Memory-map the frame thumbnail sidecar of a video, or return None if it is missing"""
+    return _load_sidecar(frames_dir, THUMBS_FILENAME)
+
+def load_frame_tiles(frames_dir):
+    """Memory-map the frame tile sidecar of a video, or return None if it is missing"""
+    return _load_sidecar(frames_dir, TILES_FILENAME)
 
 def get_video_info(video_path):
     """Get basic information about a video file"""
@@ -0,0 +1,22 @@
+# Gunicorn configuration for News-Scan-AI
+# Usage: gunicorn -c gunicorn.conf.py
+
+# app.py is shadowed by the app/ package, so it is loaded through wsgi.py
+wsgi_app = 'wsgi:app'
+bind = '0.0.0.0:5000'
+
+# A single threaded worker: processing status, the background job queue and
+# its de-duplication live in process memory, so more workers would each see
+# only part of them (and could extract the same video twice). Threads let long
+# video uploads overlap with searches; frame extraction and matching release
+# the GIL in OpenCV/NumPy.
+workers = 1
+worker_class = 'gthread'
+threads = 16
+
+# Large uploads and frame extraction can take several minutes
+timeout = 600
+
+# Recycle workers periodically; the jitter keeps them from restarting together
+max_requests = 1000
+max_requests_jitter = 100
@@ -0,0 +1,18 @@
+"""
+WSGI entry point for News-Scan-AI
+Loads app.py by path, since `import app` resolves to the app/ package
+"""
+
+import importlib.util
+import os
+
+_spec = importlib.util.spec_from_file_location(
+    'news_scan_ai', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+)
+_module = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_module)
+
+# Create the working directories and database before serving
+_module._bootstrap()
+
+app = _module.app